@@ -0,0 +1,111 @@
+"""对比不同分析模式的延迟和准确率
+
+标注语料为JSON列表, 每项格式:
+    {
+        "metric_type": "cpu",
+        "service": "order-service",
+        "plot_path": "s3://bucket/plots/cpu/order-service/plot_xxx.jpg",
+        "digest_path": "s3://bucket/plots/cpu/order-service/digest_xxx.json",
+        "anomalous_pods": ["order-service-7d9f-10.0.1.23:8080"]
+    }
+
+用法:
+    python benchmark_modes.py corpus.json --modes image text cascade --cascade-threshold 0.8
+
+cascade为启用级联初筛的图表模式, 额外统计由初筛直接给出结论的比例。
+"""
+import json
+import math
+import time
+import argparse
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional
+
+from metrics_analyzer import DifyClient, MetricsRecorder, logger
+
+def parse_result_pods(result_xml: str) -> List[str]:
+    """从检测结果XML中提取异常Pod名称列表"""
+    if not result_xml or '无异常' in result_xml:
+        return []
+    root = ET.fromstring(result_xml)
+    return [child.text.strip() for child in root if child.text and child.text.strip()]
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩法计算分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def _match(predicted: str, expected: str) -> bool:
+    """LLM返回的Pod名称可能带或不带节点后缀, 按包含关系匹配"""
+    predicted, expected = predicted.lower(), expected.lower()
+    return predicted in expected or expected in predicted
+
+def run_mode(client: DifyClient, corpus: List[Dict], mode: str,
+             cascade_threshold: float = 0.0) -> Dict:
+    """对语料逐条调用Dify, 统计延迟分位数和Pod级别的精确率/召回率"""
+    metrics = MetricsRecorder('benchmark', '', sampled=False)
+    latencies = []
+    tp = fp = fn = errors = skipped = triaged = 0
+    # analyze_plot会在缺少输入时改用另一种模式, 基准测试中跳过这些用例, 避免混入另一种模式的结果
+    required = 'digest_path' if mode == 'text' else 'plot_path'
+
+    for case in corpus:
+        if not case.get(required):
+            logger.warning(f"跳过缺少{required}的用例: {case.get('service')}")
+            skipped += 1
+            continue
+        expected = case.get('anomalous_pods', [])
+        try:
+            start = time.perf_counter()
+            api_result, _ = client.analyze_plot(case, case['metric_type'], mode, metrics,
+                                                cascade_threshold)
+            latencies.append(time.perf_counter() - start)
+            triaged += api_result.get('tier') == 'triage'
+            predicted = parse_result_pods(api_result.get('result', ''))
+        except Exception as e:
+            logger.error(f"基准测试调用失败 {case.get('service')}: {str(e)}")
+            errors += 1
+            continue
+
+        hits = sum(1 for p in predicted if any(_match(p, e) for e in expected))
+        tp += hits
+        fp += len(predicted) - hits
+        fn += sum(1 for e in expected if not any(_match(p, e) for p in predicted))
+
+    return {
+        'mode': 'cascade' if cascade_threshold > 0 else mode,
+        'cascade_threshold': cascade_threshold,
+        'cases': len(corpus),
+        'skipped': skipped,
+        'errors': errors,
+        'triage_ratio': triaged / len(latencies) if latencies else None,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'precision': tp / (tp + fp) if tp + fp else None,
+        'recall': tp / (tp + fn) if tp + fn else None
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='对比图表/数值摘要分析模式的延迟和准确率')
+    parser.add_argument('corpus', help='标注语料JSON文件')
+    parser.add_argument('--modes', nargs='+', default=['image', 'text'],
+                        choices=['image', 'text', 'cascade'])
+    parser.add_argument('--cascade-threshold', type=float, default=0.8,
+                        help='cascade模式的初筛置信度阈值')
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding='utf-8') as f:
+        corpus = json.load(f)
+
+    client = DifyClient()
+    report = [
+        run_mode(client, corpus, 'image', args.cascade_threshold) if mode == 'cascade'
+        else run_mode(client, corpus, mode)
+        for mode in args.modes
+    ]
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
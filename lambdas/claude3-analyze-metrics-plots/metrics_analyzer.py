@@ -1,4 +1,8 @@
+import os
 import json
+import uuid
+import random
+import contextlib
 import urllib.request
 import urllib.error
 import logging
@@ -27,6 +31,13 @@ class Config:
     DIFY_MAX_RETRIES = 3  # 最大重试次数
     DIFY_RETRY_DELAY = 5  # 重试间隔(秒)
     
+    # 分析模式: image=图表输入(默认工作流), text=数值摘要输入(文本版工作流)
+    ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'image')
+    DIFY_TEXT_API_KEY = "app-XXXXXXXXXXXXXXXX"  # 文本版工作流的API Key
+    
+    # 级联模式: 小模型初筛置信度达到该阈值且判定正常时直接结束, 否则升级到大模型 (0表示关闭, 仅图表模式)
+    DIFY_CASCADE_THRESHOLD = float(os.environ.get('DIFY_CASCADE_THRESHOLD', '0'))
+    
     # Lark配置
     LARK_WEBHOOK = "https://open.larksuite.com/open-apis/bot/v2/hook/477XXXXXX4ab5"
     LARK_TIMEOUT = 10
@@ -43,6 +54,10 @@ class Config:
     
     # 处理配置
     MIN_REMAINING_TIME = 30
+    
+    # 监控指标配置 (采样率为0时不记录任何阶段耗时)
+    METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0'))
+    METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'BedrockWatch')
 
     # 异常级别配置
     SEVERITY_LEVELS = {
@@ -70,6 +85,70 @@ class DifyAPIError(Exception):
     """Dify API调用异常"""
     pass
 
+class MetricsRecorder:
+    """阶段耗时与计数记录器，以CloudWatch EMF格式输出"""
+    def __init__(self, function_name: str, trace_id: str, sampled: bool,
+                 dimensions: Optional[Dict] = None):
+        self.function_name = function_name
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.dimensions = dimensions or {}
+        self.timings = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def _timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def timer(self, stage: str):
+        """记录某阶段耗时(毫秒)，同一阶段多次调用时累加"""
+        if not self.sampled:
+            return contextlib.nullcontext()
+        return self._timed(stage)
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """累加计数器"""
+        if self.sampled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush(self) -> None:
+        """以单行EMF JSON输出所有已记录的指标"""
+        if not self.sampled or not (self.timings or self.counters):
+            return
+        dimensions = {'Function': self.function_name, **self.dimensions}
+        metrics = ([{'Name': f"{stage}_ms", 'Unit': 'Milliseconds'} for stage in self.timings] +
+                   [{'Name': name, 'Unit': 'Count'} for name in self.counters])
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': Config.METRICS_NAMESPACE,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': metrics
+                }]
+            },
+            **dimensions,
+            'trace_id': self.trace_id,
+            **{f"{stage}_ms": round(ms, 3) for stage, ms in self.timings.items()},
+            **self.counters
+        }
+        # EMF需直接写到stdout, 不能带日志前缀
+        print(json.dumps(record), flush=True)
+        self.timings.clear()
+        self.counters.clear()
+
+def new_trace(function_name: str, trace_id: Optional[str] = None, sampled: Optional[bool] = None,
+              **dimensions) -> MetricsRecorder:
+    """创建追踪记录器，未指定时按采样率决定是否记录"""
+    if sampled is None:
+        sampled = Config.METRICS_SAMPLE_RATE > 0 and random.random() < Config.METRICS_SAMPLE_RATE
+    return MetricsRecorder(function_name, trace_id or uuid.uuid4().hex, sampled, dimensions)
+
 class S3Client:
     """S3操作客户端"""
     def __init__(self):
@@ -78,23 +157,33 @@ class S3Client:
     def get_presigned_url(self, bucket: str, key: str) -> str:
         """生成预签名URL"""
         try:
-            logger.info(f"生成S3预签名URL - Bucket: {bucket}, Key: {key}")
+            logger.info("生成S3预签名URL - Bucket: %s, Key: %s", bucket, key)
             url = self.client.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': bucket, 'Key': key},
                 ExpiresIn=Config.S3_URL_EXPIRY
             )
-            logger.info(f"生成预签名URL成功")
+            logger.info("生成预签名URL成功")
             return url
         except Exception as e:
             logger.error(f"生成预签名URL失败: {str(e)}")
             raise
 
+    def get_object_text(self, bucket: str, key: str) -> str:
+        """读取S3文本对象"""
+        try:
+            logger.info("读取S3对象 - Bucket: %s, Key: %s", bucket, key)
+            response = self.client.get_object(Bucket=bucket, Key=key)
+            return response['Body'].read().decode('utf-8')
+        except Exception as e:
+            logger.error(f"读取S3对象失败: {str(e)}")
+            raise
+
     @staticmethod
     def parse_s3_url(s3_url: str) -> Tuple[str, str]:
         """解析S3 URL"""
         try:
-            logger.debug(f"解析S3 URL: {s3_url}")
+            logger.debug("解析S3 URL: %s", s3_url)
             parsed = urlparse(s3_url)
             bucket = parsed.netloc
             key = parsed.path.lstrip('/')
@@ -118,7 +207,7 @@ def get_metric_type(source_file: str) -> Optional[str]:
 def make_http_request(url: str, method: str, headers: Dict, data: Optional[Dict] = None, timeout: int = 30) -> Dict:
     """通用HTTP请求函数"""
     try:
-        logger.info(f"发起HTTP请求 - URL: {url}, Method: {method}")
+        logger.info("发起HTTP请求 - URL: %s, Method: %s", url, method)
         
         request = urllib.request.Request(
             url,
@@ -129,7 +218,7 @@ def make_http_request(url: str, method: str, headers: Dict, data: Optional[Dict]
         
         with urllib.request.urlopen(request, timeout=timeout) as response:
             response_data = response.read()
-            logger.info(f"请求成功 - 状态码: {response.status}")
+            logger.info("请求成功 - 状态码: %s", response.status)
             try:
                 return json.loads(response_data)
             except json.JSONDecodeError:
@@ -154,16 +243,16 @@ class DifyClient:
         self.api_key = Config.DIFY_API_KEY
         self.s3_client = S3Client()
 
-    def _call_dify_api(self, payload: Dict) -> Dict:
+    def _call_dify_api(self, payload: Dict, api_key: Optional[str] = None) -> Dict:
         """调用Dify API并处理重试"""
         headers = {
-            "Authorization": f"Bearer {self.api_key}",
+            "Authorization": f"Bearer {api_key or self.api_key}",
             "Content-Type": "application/json"
         }
         
         for attempt in range(Config.DIFY_MAX_RETRIES):
             try:
-                logger.info(f"调用Dify API (尝试 {attempt + 1}/{Config.DIFY_MAX_RETRIES})")
+                logger.info("调用Dify API (尝试 %d/%d)", attempt + 1, Config.DIFY_MAX_RETRIES)
                 response = make_http_request(
                     url=self.endpoint,
                     method='POST',
@@ -192,24 +281,29 @@ class DifyClient:
                 if 'result' not in outputs:
                     raise DifyAPIError(f"outputs缺少result字段: {outputs}")
                 
+                # 级联模式下由初筛结束的分支会返回tier=triage, 其余均为大模型结论
+                tier = outputs.get('tier') or 'full'
+                
                 # 判断是否无异常
                 result_xml = outputs.get('result', '')
                 if '无异常' in result_xml:
-                    logger.info("检测结果:无异常")
+                    logger.info("检测结果:无异常 (tier=%s)", tier)
                     return {
                         'result': result_xml,
-                        'has_anomaly': False
+                        'has_anomaly': False,
+                        'tier': tier
                     }
 
                 # 有异常时验证x字段
                 if 'x' not in outputs:
                     raise DifyAPIError(f"异常分析缺少x字段: {outputs}")
                 
-                logger.info("检测结果:发现异常")
+                logger.info("检测结果:发现异常 (tier=%s)", tier)
                 return {
                     'result': result_xml,
                     'x': outputs['x'],
-                    'has_anomaly': True
+                    'has_anomaly': True,
+                    'tier': tier
                 }
                 
             except Exception as e:
@@ -291,51 +385,102 @@ class DifyClient:
             logger.error(f"数据处理错误: {str(e)}")
             raise
 
-    def analyze_plots(self, plots_data: List[Dict], metric_type: str) -> List[Dict]:
-        """分析图表数据"""
+    @staticmethod
+    def _resolve_mode(plot: Dict, mode: str) -> str:
+        """按消息中实际存在的字段确定分析模式, 配置的模式缺少对应输入时回退到另一种模式"""
+        available = [m for m, field in (('image', 'plot_path'), ('text', 'digest_path')) if plot.get(field)]
+        if not available:
+            raise ValueError(f"消息中既没有plot_path也没有digest_path - Service: {plot.get('service')}")
+        if mode not in available:
+            logger.warning("Service %s 缺少%s模式所需的输入, 改用%s模式",
+                           plot.get('service'), mode, available[0])
+            return available[0]
+        return mode
+
+    def analyze_plot(self, plot: Dict, metric_type: str, mode: str,
+                     metrics: MetricsRecorder,
+                     cascade_threshold: Optional[float] = None) -> Tuple[Dict, Optional[str]]:
+        """调用Dify分析单个服务, 返回(API结果, 图表预签名URL)"""
+        if cascade_threshold is None:
+            cascade_threshold = Config.DIFY_CASCADE_THRESHOLD
+        mode = self._resolve_mode(plot, mode)
+
+        plot_url = None
+        if plot.get('plot_path'):
+            with metrics.timer('presign'):
+                bucket, key = self.s3_client.parse_s3_url(plot['plot_path'])
+                plot_url = self.s3_client.get_presigned_url(bucket, key)
+        
+        if mode == 'text':
+            with metrics.timer('digest_fetch'):
+                bucket, key = self.s3_client.parse_s3_url(plot['digest_path'])
+                digest = self.s3_client.get_object_text(bucket, key)
+            inputs = {metric_type: digest}
+            api_key = Config.DIFY_TEXT_API_KEY
+        else:
+            inputs = {
+                metric_type: {
+                    "type": "image",
+                    "transfer_method": "remote_url",
+                    "url": plot_url
+                }
+            }
+            if cascade_threshold > 0:
+                inputs["cascade_threshold"] = cascade_threshold
+            api_key = self.api_key
+        
+        payload = {
+            "inputs": inputs,
+            "response_mode": "blocking",
+            "user": "lambda-user"
+        }
+        
+        # 调用Dify API
+        with metrics.timer('dify_roundtrip'):
+            api_result = self._call_dify_api(payload, api_key)
+        metrics.incr('dify_calls')
+        metrics.incr(f"dify_tier_{api_result['tier']}")
+        return api_result, plot_url
+
+    def analyze_plots(self, plots_data: List[Dict], metric_type: str,
+                      metrics: Optional[MetricsRecorder] = None,
+                      mode: Optional[str] = None,
+                      cascade_threshold: Optional[float] = None) -> List[Dict]:
+        """分析图表数据, mode为text时改为发送数值摘要, cascade_threshold大于0时启用级联初筛"""
         if not plots_data:
             logger.warning("plots_data为空")
             return []
             
+        metrics = metrics or MetricsRecorder('metrics_analyzer', '', sampled=False)
+        mode = mode or Config.ANALYSIS_MODE
         results = []
         
         for plot in plots_data:
             try:
-                logger.info(f"处理图表 - Service: {plot.get('service')}")
-                bucket, key = self.s3_client.parse_s3_url(plot['plot_path'])
-                presigned_url = self.s3_client.get_presigned_url(bucket, key)
-                
-                payload = {
-                    "inputs": {
-                        metric_type: {
-                            "type": "image",
-                            "transfer_method": "remote_url",
-                            "url": presigned_url
-                        }
-                    },
-                    "response_mode": "blocking",
-                    "user": "lambda-user"
-                }
-                
-                # 调用Dify API
-                api_result = self._call_dify_api(payload)
+                logger.info("处理图表 - Service: %s", plot.get('service'))
+                api_result, plot_url = self.analyze_plot(plot, metric_type, mode, metrics,
+                                                         cascade_threshold)
                 
                 if not api_result.get('has_anomaly'):
                     # 无异常情况,跳过
-                    logger.info(f"Service {plot['service']} 未发现异常")
+                    logger.info("Service %s 未发现异常", plot['service'])
                     continue
                 
+                metrics.incr('anomalies')
+                
                 # 有异常情况
                 result_xml = api_result['result']
                 analysis_xml = api_result['x']
                 
                 if result_xml and analysis_xml:
-                    analysis = self.parse_analysis_xml(result_xml, analysis_xml)
+                    with metrics.timer('xml_parse'):
+                        analysis = self.parse_analysis_xml(result_xml, analysis_xml)
                     if analysis:
                         results.append({
                             'service': plot['service'],
                             'analysis': analysis,
-                            'plot_url': presigned_url
+                            'plot_url': plot_url,
+                            'tier': api_result['tier']
                         })
                     else:
                         logger.warning(f"跳过无效的分析结果 - Service: {plot.get('service')}")
@@ -343,6 +488,7 @@ class DifyClient:
                     logger.warning(f"Dify返回的XML数据为空 - Service: {plot.get('service')}")
 
             except Exception as e:
+                metrics.incr('plot_errors')
                 logger.error(f"处理图表失败 {plot.get('service', 'unknown')}: {str(e)}")
 
         return results
@@ -396,6 +542,8 @@ class LarkBot:
         }
 
         # 添加每个异常pod的详细信息
+        # 数值摘要模式下可能没有图表
+        plot_link = f" [📊查看监控]({plot_url})" if plot_url else ""
         for pod in analysis_data['pods']:
             if pod['name']:  # 只添加有效的Pod信息
                 pod_info = {
@@ -403,7 +551,7 @@ class LarkBot:
                     "text": {
                         "content": (
                             f"🔍 **Pod**: {pod['name']}\n"
-                            f"**置信度**: {pod['confidence']} [📊查看监控]({plot_url})\n"
+                            f"**置信度**: {pod['confidence']}{plot_link}\n"
                             f"**优先级**: {pod['priority']}\n"
                             f"**可能原因**: {pod['probable_cause']}"
                         ),
@@ -521,6 +669,47 @@ class LarkBot:
             logger.error(f"发送Lark消息失败: {str(e)}")
             raise
 
+def process_message(message: Dict, dify_client: Optional[DifyClient] = None,
+                    lark_bot: Optional[LarkBot] = None) -> List[Dict]:
+    """处理一条csv2image图表消息: 调用Dify分析并推送Lark"""
+    plots = message['plots']
+    time_window = message['time_window_hours']
+    source_csv = message['source_csv']
+    
+    metric_type = message.get('metric_type') or get_metric_type(source_csv)
+    if not metric_type:
+        raise ValueError(f"无法确定指标类型: {source_csv}")
+
+    # 沿用csv2image生成的trace_id，便于端到端追踪同一个CSV
+    metrics = new_trace(
+        'metrics_analyzer',
+        trace_id=message.get('trace_id'),
+        sampled=message.get('trace_sampled'),
+        MetricType=metric_type
+    )
+    logger.info("处理指标类型: %s (trace_id=%s)", metric_type, metrics.trace_id)
+    
+    # 调用Dify分析
+    dify_client = dify_client or DifyClient()
+    analysis_results = dify_client.analyze_plots(plots, metric_type, metrics)
+    
+    if analysis_results:
+        # 发送Lark消息
+        logger.info("发送分析结果到Lark")
+        lark_bot = lark_bot or LarkBot()
+        with metrics.timer('lark_send'):
+            lark_bot.send_message(
+                analysis_results,
+                source_csv,
+                time_window,
+                metric_type
+            )
+    else:
+        logger.info("未发现异常,跳过发送消息")
+    
+    metrics.flush()
+    return analysis_results
+
 def lambda_handler(event, context):
     """Lambda处理函数"""
     try:
@@ -545,34 +734,7 @@ def lambda_handler(event, context):
                     continue
                 
                 message = json.loads(record['body'])
-                
-                plots = message['plots']
-                time_window = message['time_window_hours']
-                source_csv = message['source_csv']
-                
-                metric_type = message.get('metric_type') or get_metric_type(source_csv)
-                if not metric_type:
-                    raise ValueError(f"无法确定指标类型: {source_csv}")
-
-                logger.info(f"处理指标类型: {metric_type}")
-                
-                # 调用Dify分析
-                dify_client = DifyClient()
-                analysis_results = dify_client.analyze_plots(plots, metric_type)
-                
-                if analysis_results:
-                    # 发送Lark消息
-                    logger.info("发送分析结果到Lark")
-                    lark_bot = LarkBot()
-                    lark_bot.send_message(
-                        analysis_results,
-                        source_csv,
-                        time_window,
-                        metric_type
-                    )
-                else:
-                    logger.info("未发现异常,跳过发送消息")
-                
+                process_message(message)
                 logger.info("消息处理完成")
 
             except Exception as e:
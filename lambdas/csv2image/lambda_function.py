@@ -1,13 +1,25 @@
+import io
 import os
+import csv
 import json
+import math
+import time
+import uuid
+import random
 import logging
+import contextlib
 import boto3
+from botocore.exceptions import ClientError
+import numpy as np
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
 import tempfile
+from typing import Dict, List, Optional, Tuple
+from prometheus_adapter import PrometheusClient
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -17,10 +29,37 @@ class Config:
     BUCKET_NAME = os.environ['BUCKET_NAME']
     INPUT_PREFIX = os.environ.get('INPUT_PREFIX', 'data/')
     OUTPUT_PREFIX = os.environ.get('OUTPUT_PREFIX', 'plots/')
-    QUEUE_URL = os.environ['QUEUE_URL']
+    # 常驻worker模式下图表消息走进程内队列, 可不配置SQS
+    QUEUE_URL = os.environ.get('QUEUE_URL', '')
     TIME_WINDOW_HOURS = int(os.environ.get('TIME_WINDOW_HOURS', '8'))
     TIME_INTERVAL_MINUTES = 15
     
+    # 输出配置: image=仅图表, digest=仅数值摘要, both=两者都生成
+    OUTPUT_MODE = os.environ.get('OUTPUT_MODE', 'image')
+    DIGEST_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+    DIGEST_TOP_K = 3
+    DIGEST_OUTLIER_Z = 3.5
+    DIGEST_CHANGE_MIN_SIGMA = 1.0
+    
+    # 分片配置: 超过阈值的CSV由协调者按服务切分后异步分发给多个实例并行处理 (默认0即关闭, 开启前需授予额外IAM权限)
+    SHARD_THRESHOLD_MB = int(os.environ.get('SHARD_THRESHOLD_MB', '0'))
+    SHARD_TARGET_MB = int(os.environ.get('SHARD_TARGET_MB', '64'))
+    SHARD_RANGE_GAP_BYTES = 1024 * 1024  # 间隔小于该值的字节区间合并为一次读取
+    SHARD_MAX_RUNS_PER_SERVICE = 16  # 字节区间数超过服务数的该倍数时视为未按服务排序, 不分片
+    SHARD_MANIFEST_SUFFIX = '.manifest.json'
+    
+    # Prometheus数据源配置 (由定时事件触发, 不经过CSV/S3)
+    PROMETHEUS_URL = os.environ.get('PROMETHEUS_URL', '')
+    PROMETHEUS_STEP = os.environ.get('PROMETHEUS_STEP', '60s')
+    PROMETHEUS_TIMEOUT = int(os.environ.get('PROMETHEUS_TIMEOUT', '30'))
+    PROMETHEUS_SERVICE_LABEL = os.environ.get('PROMETHEUS_SERVICE_LABEL', 'service')
+    PROMETHEUS_POD_LABEL = os.environ.get('PROMETHEUS_POD_LABEL', 'pod')
+    PROMETHEUS_NODE_LABEL = os.environ.get('PROMETHEUS_NODE_LABEL', 'node')
+    
+    # 监控指标配置 (采样率为0时不记录任何阶段耗时)
+    METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0'))
+    METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'BedrockWatch')
+    
     # 图表样式配置
     PLOT_DPI = 300
     PLOT_FIGSIZE = (15, 8)
@@ -41,20 +80,87 @@ class Config:
         'cpu': {
             'value_column': 'cpuusage',
             'ylabel': 'CPU Usage (%)',
-            'title_prefix': 'CPU Usage'
+            'title_prefix': 'CPU Usage',
+            'promql': os.environ.get('PROMQL_CPU', '')
         },
         'memory': {
             'value_column': 'memusage',
             'ylabel': 'Memory Usage (%)',
-            'title_prefix': 'Memory Usage'
+            'title_prefix': 'Memory Usage',
+            'promql': os.environ.get('PROMQL_MEMORY', '')
         },
         'network': {
             'value_column': 'netusage',
             'ylabel': 'Network Usage (Mbps)',
-            'title_prefix': 'Network Usage'
+            'title_prefix': 'Network Usage',
+            'promql': os.environ.get('PROMQL_NETWORK', '')
         }
     }
 
+class MetricsRecorder:
+    """阶段耗时与计数记录器，以CloudWatch EMF格式输出"""
+    def __init__(self, function_name: str, trace_id: str, sampled: bool,
+                 dimensions: dict = None):
+        self.function_name = function_name
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.dimensions = dimensions or {}
+        self.timings = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def _timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def timer(self, stage: str):
+        """记录某阶段耗时(毫秒)，同一阶段多次调用时累加"""
+        if not self.sampled:
+            return contextlib.nullcontext()
+        return self._timed(stage)
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """累加计数器"""
+        if self.sampled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush(self) -> None:
+        """以单行EMF JSON输出所有已记录的指标"""
+        if not self.sampled or not (self.timings or self.counters):
+            return
+        dimensions = {'Function': self.function_name, **self.dimensions}
+        metrics = ([{'Name': f"{stage}_ms", 'Unit': 'Milliseconds'} for stage in self.timings] +
+                   [{'Name': name, 'Unit': 'Count'} for name in self.counters])
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': Config.METRICS_NAMESPACE,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': metrics
+                }]
+            },
+            **dimensions,
+            'trace_id': self.trace_id,
+            **{f"{stage}_ms": round(ms, 3) for stage, ms in self.timings.items()},
+            **self.counters
+        }
+        # EMF需直接写到stdout, 不能带日志前缀
+        print(json.dumps(record), flush=True)
+        self.timings.clear()
+        self.counters.clear()
+
+def new_trace(function_name: str, trace_id: str = None, sampled: bool = None,
+              **dimensions) -> MetricsRecorder:
+    """创建追踪记录器，未指定时按采样率决定是否记录"""
+    if sampled is None:
+        sampled = Config.METRICS_SAMPLE_RATE > 0 and random.random() < Config.METRICS_SAMPLE_RATE
+    return MetricsRecorder(function_name, trace_id or uuid.uuid4().hex, sampled, dimensions)
+
 def get_metric_type(filename: str) -> str:
     """从文件名获取指标类型"""
     filename = filename.lower()
@@ -67,50 +173,66 @@ def get_metric_type(filename: str) -> str:
     else:
         raise ValueError(f"Cannot determine metric type from filename: {filename}")
 
-def generate_plot(data: pd.DataFrame, service_name: str, config: Config, metric_type: str) -> str:
-    """生成指标图表"""
+def dataframe_to_series(data: pd.DataFrame, config: Config, metric_type: str,
+                        downsample: int = 1) -> Tuple[List[Tuple[str, np.ndarray, np.ndarray]], datetime, datetime]:
+    """截取时间窗口并按pod、node拆分为 (标签, 时间戳数组, 数值数组) 序列"""
+    # 带时区(或混合时区)的时间戳统一转换为无时区UTC的datetime64[ns], 否则to_numpy()得到object数组
+    timestamps = pd.to_datetime(data['timestamp'], utc=True).dt.tz_convert(None)
+    data = data.assign(timestamp=timestamps.astype('datetime64[ns]'))
+    max_timestamp = data['timestamp'].max()
+    min_timestamp = max_timestamp - timedelta(hours=config.TIME_WINDOW_HOURS)
+    
+    mask = (data['timestamp'] >= min_timestamp) & (data['timestamp'] <= max_timestamp)
+    window_data = data[mask].iloc[::downsample]
+    
+    value_column = config.METRICS_CONFIG[metric_type]['value_column']
+    series = [
+        (f"{pod}-{node}", group['timestamp'].to_numpy(), group[value_column].to_numpy())
+        for (pod, node), group in window_data.groupby(['pod', 'node'])
+    ]
+    return series, min_timestamp, max_timestamp
+
+def render_series_plot(series: List[Tuple[str, np.ndarray, np.ndarray]],
+                       min_timestamp: datetime, max_timestamp: datetime,
+                       service_name: str, config: Config, metric_type: str,
+                       metrics: MetricsRecorder = None) -> str:
+    """根据(标签, 时间戳数组, 数值数组)序列列表生成图表, 返回本地图片路径"""
+    metrics = metrics or MetricsRecorder('csv2image', '', sampled=False)
     try:
-        max_timestamp = data['timestamp'].max()
-        min_timestamp = max_timestamp - timedelta(hours=config.TIME_WINDOW_HOURS)
-        
-        mask = (data['timestamp'] >= min_timestamp) & (data['timestamp'] <= max_timestamp)
-        plot_data = data[mask].iloc[::2]
-        
-        plt.figure(figsize=config.PLOT_FIGSIZE)
-        metric_config = config.METRICS_CONFIG[metric_type]
-        value_column = metric_config['value_column']
-        
-        for idx, (_, group) in enumerate(plot_data.groupby(['pod', 'node'])):
-            label = f"{group['pod'].iloc[0]}-{group['node'].iloc[0]}"
-            plt.plot(
-                group['timestamp'],
-                group[value_column],
-                label=label,
-                color=config.PLOT_COLORS[idx % len(config.PLOT_COLORS)],
-                linestyle='-',
-                marker='o',
-                markersize=config.PLOT_MARKER_SIZE,
-                linewidth=config.PLOT_LINE_WIDTH
-            )
+        with metrics.timer('render'):
+            plt.figure(figsize=config.PLOT_FIGSIZE)
+            metric_config = config.METRICS_CONFIG[metric_type]
+        
+            for idx, (label, timestamps, values) in enumerate(series):
+                plt.plot(
+                    timestamps,
+                    values,
+                    label=label,
+                    color=config.PLOT_COLORS[idx % len(config.PLOT_COLORS)],
+                    linestyle='-',
+                    marker='o',
+                    markersize=config.PLOT_MARKER_SIZE,
+                    linewidth=config.PLOT_LINE_WIDTH
+                )
 
-        time_interval = timedelta(minutes=config.TIME_INTERVAL_MINUTES)
-        ticks = pd.date_range(start=min_timestamp, end=max_timestamp, freq=time_interval)
-        plt.xticks(ticks, [t.strftime('%Y-%m-%d %H:%M') for t in ticks], rotation=45)
-        
-        plt.title(f"{metric_config['title_prefix']} - {service_name}\n"
-                 f"8-hour window with downsampled data: "
-                 f"{min_timestamp.strftime('%Y-%m-%d %H:%M')} to {max_timestamp.strftime('%Y-%m-%d %H:%M')}",
-                 fontsize=config.TITLE_FONTSIZE,
-                 fontweight='bold')
-        
-        plt.xlabel('Time', fontsize=config.LABEL_FONTSIZE)
-        plt.ylabel(metric_config['ylabel'], fontsize=config.LABEL_FONTSIZE)
-        plt.grid(True, linestyle='-', alpha=config.PLOT_GRID_ALPHA)
-        plt.xticks(fontsize=config.TICK_FONTSIZE)
-        plt.yticks(fontsize=config.TICK_FONTSIZE)
-        plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', 
-                  fontsize=config.LEGEND_FONTSIZE, frameon=True, borderaxespad=0.)
-        plt.tight_layout()
+            time_interval = timedelta(minutes=config.TIME_INTERVAL_MINUTES)
+            ticks = pd.date_range(start=min_timestamp, end=max_timestamp, freq=time_interval)
+            plt.xticks(ticks, [t.strftime('%Y-%m-%d %H:%M') for t in ticks], rotation=45)
+        
+            plt.title(f"{metric_config['title_prefix']} - {service_name}\n"
+                     f"8-hour window with downsampled data: "
+                     f"{min_timestamp.strftime('%Y-%m-%d %H:%M')} to {max_timestamp.strftime('%Y-%m-%d %H:%M')}",
+                     fontsize=config.TITLE_FONTSIZE,
+                     fontweight='bold')
+        
+            plt.xlabel('Time', fontsize=config.LABEL_FONTSIZE)
+            plt.ylabel(metric_config['ylabel'], fontsize=config.LABEL_FONTSIZE)
+            plt.grid(True, linestyle='-', alpha=config.PLOT_GRID_ALPHA)
+            plt.xticks(fontsize=config.TICK_FONTSIZE)
+            plt.yticks(fontsize=config.TICK_FONTSIZE)
+            plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', 
+                      fontsize=config.LEGEND_FONTSIZE, frameon=True, borderaxespad=0.)
+            plt.tight_layout()
 
         temp_file = tempfile.NamedTemporaryFile(
             suffix='.jpg',
@@ -119,8 +241,9 @@ def generate_plot(data: pd.DataFrame, service_name: str, config: Config, metric_
             delete=False
         )
         
-        plt.savefig(temp_file.name, dpi=config.PLOT_DPI,
-                   bbox_inches='tight', facecolor='white', edgecolor='none')
+        with metrics.timer('encode'):
+            plt.savefig(temp_file.name, dpi=config.PLOT_DPI,
+                       bbox_inches='tight', facecolor='white', edgecolor='none')
         plt.close()
         
         return temp_file.name
@@ -129,6 +252,495 @@ def generate_plot(data: pd.DataFrame, service_name: str, config: Config, metric_
         logger.error(f"Error generating plot: {str(e)}")
         raise
 
+def _change_points(timestamps: np.ndarray, values: np.ndarray, std: float,
+                   config: Config) -> List[Dict]:
+    """相邻窗口均值差检测均值突变点, 返回幅度最大的若干个(互相间隔至少一个窗口)"""
+    window = max(3, len(values) // 20)
+    if len(values) < 2 * window or std == 0:
+        return []
+    
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(window, len(values) - window + 1)
+    shift = ((csum[idx + window] - csum[idx]) - (csum[idx] - csum[idx - window])) / window
+    
+    points = []
+    for i in np.argsort(-np.abs(shift)):
+        if len(points) >= config.DIGEST_TOP_K or abs(shift[i]) < config.DIGEST_CHANGE_MIN_SIGMA * std:
+            break
+        if all(abs(idx[i] - p) >= window for p, _ in points):
+            points.append((idx[i], shift[i]))
+    return [{'timestamp': str(np.datetime_as_string(timestamps[p], unit='s')), 'shift': round(float(d), 4)}
+            for p, d in sorted(points)]
+
+def _robust_baseline(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """以两侧相邻点(不含该点本身)的滑动中位数作为局部基线, 返回 (基线, 残差的稳健z分数(MAD))
+    
+    减去局部基线可避免水平突变后的整段数据都被判为离群; 中位数不受单个尖刺影响,
+    尖刺相邻点的残差保持正常。
+    """
+    half = max(3, len(values) // 40)
+    series = pd.Series(values)
+    left = series.rolling(half).median().shift(1).to_numpy()
+    right = series[::-1].rolling(half).median().shift(1).to_numpy()[::-1]
+    # 序列两端只有一侧有相邻点
+    baseline = np.where(np.isnan(left), right, np.where(np.isnan(right), left, (left + right) / 2))
+    baseline = np.where(np.isnan(baseline), values, baseline)
+    
+    residual = values - baseline
+    median = np.median(residual)
+    mad = np.median(np.abs(residual - median))
+    if mad == 0:
+        return baseline, np.zeros(len(values))
+    return baseline, 0.6745 * (residual - median) / mad
+
+def _outliers(timestamps: np.ndarray, values: np.ndarray, robust_z: np.ndarray,
+              config: Config) -> List[Dict]:
+    """返回稳健z分数偏离最大的若干个点"""
+    candidates = np.flatnonzero(np.abs(robust_z) >= config.DIGEST_OUTLIER_Z)
+    top = candidates[np.argsort(-np.abs(robust_z[candidates]))[:config.DIGEST_TOP_K]]
+    return [{'timestamp': str(np.datetime_as_string(timestamps[i], unit='s')),
+             'value': round(float(values[i]), 4),
+             'robust_z': round(float(robust_z[i]), 2)}
+            for i in np.sort(top)]
+
+def compute_digest(series: List[Tuple[str, np.ndarray, np.ndarray]], min_timestamp: datetime,
+                   max_timestamp: datetime, service_name: str, config: Config,
+                   metric_type: str, metrics: MetricsRecorder) -> dict:
+    """计算服务下各序列的数值摘要: 分位数、峰值、突变点和离群点"""
+    with metrics.timer('digest'):
+        digests = []
+        for label, timestamps, values in series:
+            values = np.asarray(values, dtype=np.float64)
+            finite = np.isfinite(values)
+            timestamps, values = timestamps[finite], values[finite]
+            if not len(values):
+                continue
+            
+            quantiles = np.quantile(values, config.DIGEST_QUANTILES)
+            std = float(values.std())
+            baseline, robust_z = _robust_baseline(values)
+            # 离群点替换为基线后再检测突变点, 单个尖刺不会在其前后产生突变点
+            cleaned = np.where(np.abs(robust_z) >= config.DIGEST_OUTLIER_Z, baseline, values)
+            peak = int(values.argmax())
+            digests.append({
+                'name': label,
+                'count': int(len(values)),
+                'mean': round(float(values.mean()), 4),
+                'std': round(std, 4),
+                'min': round(float(values.min()), 4),
+                'max': round(float(values.max()), 4),
+                'quantiles': {f"p{int(q * 100)}": round(float(v), 4)
+                              for q, v in zip(config.DIGEST_QUANTILES, quantiles)},
+                'peak': {'timestamp': str(np.datetime_as_string(timestamps[peak], unit='s')),
+                         'value': round(float(values[peak]), 4)},
+                'change_points': _change_points(timestamps, cleaned, float(cleaned.std()), config),
+                'outliers': _outliers(timestamps, values, robust_z, config)
+            })
+        
+        # 各pod中位数相对服务整体中位数的比例, 便于横向比较
+        if digests:
+            service_p50 = float(np.median([d['quantiles']['p50'] for d in digests]))
+            for d in digests:
+                d['p50_vs_service'] = round(d['quantiles']['p50'] / service_p50, 3) if service_p50 else None
+        
+    return {
+        'service': service_name,
+        'metric_type': metric_type,
+        'unit': config.METRICS_CONFIG[metric_type]['ylabel'],
+        'window_start': pd.Timestamp(min_timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+        'window_end': pd.Timestamp(max_timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+        'series': digests
+    }
+
+def upload_plot(plot_file: str, service_name: str, metric_type: str,
+                config: Config, s3, metrics: MetricsRecorder) -> str:
+    """上传图表到S3并删除本地文件, 返回S3路径"""
+    output_key = (f"{config.OUTPUT_PREFIX}{metric_type}/{service_name}/"
+                 f"plot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
+    
+    with metrics.timer('upload'):
+        s3.upload_file(plot_file, config.BUCKET_NAME, output_key)
+    metrics.incr('plots')
+    os.unlink(plot_file)
+    return f"s3://{config.BUCKET_NAME}/{output_key}"
+
+def upload_digest(digest: dict, service_name: str, metric_type: str,
+                  config: Config, s3, metrics: MetricsRecorder) -> str:
+    """上传数值摘要JSON到S3, 返回S3路径"""
+    output_key = (f"{config.OUTPUT_PREFIX}{metric_type}/{service_name}/"
+                 f"digest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    
+    with metrics.timer('upload'):
+        s3.put_object(
+            Bucket=config.BUCKET_NAME,
+            Key=output_key,
+            Body=json.dumps(digest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+            ContentType='application/json'
+        )
+    metrics.incr('digests')
+    return f"s3://{config.BUCKET_NAME}/{output_key}"
+
+def publish_service(service_name: str, plot_series: List[Tuple[str, np.ndarray, np.ndarray]],
+                    digest_series: List[Tuple[str, np.ndarray, np.ndarray]],
+                    min_timestamp: datetime, max_timestamp: datetime, source: str,
+                    metric_type: str, config: Config, s3, metrics: MetricsRecorder) -> dict:
+    """按OUTPUT_MODE生成并上传图表和/或数值摘要, 返回图表信息"""
+    result = {
+        'service': service_name,
+        'source_csv': source,
+        'metric_type': metric_type,
+        'time_window_hours': config.TIME_WINDOW_HOURS
+    }
+    if config.OUTPUT_MODE in ('image', 'both'):
+        plot_file = render_series_plot(plot_series, min_timestamp, max_timestamp,
+                                       service_name, config, metric_type, metrics)
+        result['plot_path'] = upload_plot(plot_file, service_name, metric_type, config, s3, metrics)
+    if config.OUTPUT_MODE in ('digest', 'both'):
+        digest = compute_digest(digest_series, min_timestamp, max_timestamp,
+                                service_name, config, metric_type, metrics)
+        result['digest_path'] = upload_digest(digest, service_name, metric_type, config, s3, metrics)
+    return result
+
+def build_plot_message(source: str, metric_type: str, config: Config,
+                       results: List[Dict], metrics: MetricsRecorder) -> dict:
+    """构造发往metrics_analyzer的图表消息"""
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'source_csv': source,
+        'metric_type': metric_type,
+        'time_window_hours': config.TIME_WINDOW_HOURS,
+        'trace_id': metrics.trace_id,
+        'trace_sampled': metrics.sampled,
+        'plots': results
+    }
+
+def process_dataframe(df: pd.DataFrame, key: str, metric_type: str, config: Config,
+                      s3, metrics: MetricsRecorder) -> List[Dict]:
+    """按服务生成图表/数值摘要并上传S3, 返回图表信息列表"""
+    metrics.incr('csv_rows', len(df))
+    
+    with metrics.timer('group'):
+        grouped = df.groupby('service')
+        metrics.incr('services', grouped.ngroups)
+    
+    results = []
+    for service_name, service_data in grouped:
+        # 时间窗口截取和按pod、node拆分计入group阶段, render只统计绘图本身
+        with metrics.timer('group'):
+            plot_series, min_timestamp, max_timestamp = dataframe_to_series(
+                service_data, config, metric_type, downsample=2)
+            # 数值摘要使用未降采样的数据
+            digest_series = (dataframe_to_series(service_data, config, metric_type)[0]
+                             if config.OUTPUT_MODE in ('digest', 'both') else [])
+        results.append(publish_service(service_name, plot_series, digest_series,
+                                       min_timestamp, max_timestamp, key,
+                                       metric_type, config, s3, metrics))
+    return results
+
+def read_metrics_csv(source) -> pd.DataFrame:
+    """读取指标CSV, 服务名按字符串读取并去除首尾空白 (避免"007"被解析为7), 与scan_service_ranges的处理保持一致"""
+    df = pd.read_csv(source, dtype={'service': str})
+    df['service'] = df['service'].str.strip()
+    # 时间戳可能带不同的时区偏移, 统一解析为UTC (不带偏移的按UTC处理), dataframe_to_series中再去掉时区
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    return df
+
+def process_csv(csv_path: str, key: str, metric_type: str, config: Config,
+                s3, metrics: MetricsRecorder) -> dict:
+    """解析本地CSV文件, 按服务生成图表并上传S3, 返回图表消息"""
+    with metrics.timer('csv_parse'):
+        df = read_metrics_csv(csv_path)
+    
+    results = process_dataframe(df, key, metric_type, config, s3, metrics)
+    return build_plot_message(key, metric_type, config, results, metrics)
+
+def _is_interleaved(run_count: int, service_count: int, config: Config) -> bool:
+    """字节区间数远多于服务数时, CSV未按服务排序(如按时间排序的导出), 按区间分片无法减少读取量"""
+    return run_count > config.SHARD_MAX_RUNS_PER_SERVICE * max(service_count, 1)
+
+def scan_service_ranges(s3, bucket: str, key: str,
+                        config: Config) -> Optional[Tuple[str, Dict[str, List[List[int]]]]]:
+    """流式扫描一遍CSV, 返回表头和每个服务所在的字节区间列表(闭区间); CSV未按服务排序时提前结束并返回None"""
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    lines = body.iter_lines(chunk_size=1024 * 1024, keepends=True)
+    header = next(lines)
+    service_idx = next(csv.reader([header.decode('utf-8-sig')])).index('service')
+    
+    ranges = {}
+    run_count = 0
+    offset = len(header)
+    current, run_start = None, offset
+    for line in lines:
+        if line.strip():
+            if b'"' in line:
+                service = next(csv.reader([line.decode('utf-8')]))[service_idx]
+            else:
+                service = line.split(b',', service_idx + 1)[service_idx].decode('utf-8')
+            service = service.strip()
+            if service != current:
+                if current is not None:
+                    ranges.setdefault(current, []).append([run_start, offset - 1])
+                    run_count += 1
+                    if _is_interleaved(run_count, len(ranges), config):
+                        body.close()
+                        return None
+                current, run_start = service, offset
+        offset += len(line)
+    if current is not None:
+        ranges.setdefault(current, []).append([run_start, offset - 1])
+    
+    return header.decode('utf-8-sig'), ranges
+
+def load_shard_manifest(s3, bucket: str, key: str, config: Config) -> Optional[Tuple[str, Dict]]:
+    """读取CSV旁的分片清单 (<key>.manifest.json), 不存在时返回None
+    
+    清单格式: {"header": 可选表头行, "services": {"服务名": [[起始字节, 结束字节], ...]}}
+    """
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key + config.SHARD_MANIFEST_SUFFIX)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    manifest = json.loads(obj['Body'].read())
+    
+    header = manifest.get('header')
+    if not header:
+        head = s3.get_object(Bucket=bucket, Key=key, Range='bytes=0-65535')['Body'].read()
+        header = head.split(b'\n', 1)[0].decode('utf-8-sig')
+    return header, manifest['services']
+
+def partition_services(ranges: Dict[str, List[List[int]]], target_bytes: int) -> List[List[str]]:
+    """按字节数将服务分配到分片 (最大优先贪心, 单个服务不拆分)"""
+    sizes = {service: sum(end - start + 1 for start, end in spans) for service, spans in ranges.items()}
+    shard_count = max(1, min(len(sizes), math.ceil(sum(sizes.values()) / target_bytes)))
+    
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for service in sorted(sizes, key=sizes.get, reverse=True):
+        index = loads.index(min(loads))
+        shards[index].append(service)
+        loads[index] += sizes[service]
+    return shards
+
+def coalesce_ranges(ranges: List[List[int]], max_gap: int) -> List[List[int]]:
+    """合并重叠或间隔较小的字节区间, 减少get_object次数"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] - 1 <= max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def coordinate_shards(bucket: str, key: str, metric_type: str, config: Config, s3,
+                      lambda_client, function_name: str, metrics: MetricsRecorder) -> int:
+    """协调者: 划分服务分片, 写入分片任务并异步调用自身处理, 返回分片数
+    
+    分片要求同一服务的行在CSV中连续(按服务排序); 行在服务间交错时返回0, 由调用方回退到单实例处理。
+    """
+    with metrics.timer('shard_scan'):
+        manifest = load_shard_manifest(s3, bucket, key, config)
+        scanned = manifest or scan_service_ranges(s3, bucket, key, config)
+    if not scanned or _is_interleaved(sum(len(spans) for spans in scanned[1].values()),
+                                      len(scanned[1]), config):
+        logger.warning("CSV %s/%s is not grouped by service, processing without shards", bucket, key)
+        metrics.incr('shard_fallbacks')
+        return 0
+    header, ranges = scanned
+    
+    shards = partition_services(ranges, config.SHARD_TARGET_MB * 1024 * 1024)
+    prefix = f"{config.OUTPUT_PREFIX}_shards/{metrics.trace_id}/"
+    
+    with metrics.timer('shard_dispatch'):
+        for index, services in enumerate(shards):
+            work = {
+                'run_id': metrics.trace_id,
+                'trace_sampled': metrics.sampled,
+                'index': index,
+                'total': len(shards),
+                'bucket': bucket,
+                'key': key,
+                'metric_type': metric_type,
+                'header': header,
+                'services': services,
+                'ranges': coalesce_ranges([span for service in services for span in ranges[service]],
+                                          config.SHARD_RANGE_GAP_BYTES)
+            }
+            # 区间列表可能超出异步调用的负载上限, 任务内容写入S3, 调用时只传路径
+            work_key = f"{prefix}work_{index:04d}.json"
+            s3.put_object(Bucket=config.BUCKET_NAME, Key=work_key, Body=json.dumps(work).encode('utf-8'))
+            lambda_client.invoke(
+                FunctionName=function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'shard_work': f"s3://{config.BUCKET_NAME}/{work_key}"}).encode('utf-8')
+            )
+    
+    metrics.incr('shards', len(shards))
+    logger.info("Dispatched %d shards for %s/%s (trace_id=%s)",
+                len(shards), bucket, key, metrics.trace_id)
+    return len(shards)
+
+def process_shard(work: dict, config: Config, s3, metrics: MetricsRecorder) -> List[Dict]:
+    """分片worker: 按字节区间读取CSV片段, 处理分配到的服务"""
+    chunks = [work['header'].rstrip('\r\n').encode('utf-8') + b'\n']
+    for start, end in work['ranges']:
+        with metrics.timer('s3_download'):
+            chunk = s3.get_object(Bucket=work['bucket'], Key=work['key'],
+                                  Range=f"bytes={start}-{end}")['Body'].read()
+        chunks.append(chunk if chunk.endswith(b'\n') else chunk + b'\n')
+    
+    with metrics.timer('csv_parse'):
+        df = read_metrics_csv(io.BytesIO(b''.join(chunks)))
+        # 合并后的区间可能包含其他分片的服务
+        df = df[df['service'].isin(work['services'])]
+    
+    missing = set(work['services']) - set(df['service'].unique())
+    if missing:
+        logger.warning("Shard %d/%d of %s has no rows for assigned services: %s",
+                       work['index'] + 1, work['total'], work['key'], sorted(missing))
+    
+    return process_dataframe(df, work['key'], work['metric_type'], config, s3, metrics)
+
+def _object_exists(s3, bucket: str, key: str) -> bool:
+    """判断S3对象是否存在"""
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def merge_shard_results(prefix: str, work: dict, config: Config, s3,
+                        metrics: MetricsRecorder) -> Optional[dict]:
+    """所有分片完成后由最后完成的分片合并结果, 返回图表消息; 未全部完成或已由其他分片负责时返回None
+    
+    合并权通过条件写入 {prefix}merging 认领, 内容为认领分片的序号; 认领分片的重试仍可继续合并。
+    消息发送成功后由调用方写入 {prefix}merged 标记完成。
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    result_keys = sorted(
+        obj['Key']
+        for page in paginator.paginate(Bucket=config.BUCKET_NAME, Prefix=f"{prefix}result_")
+        for obj in page.get('Contents', [])
+    )
+    if len(result_keys) < work['total']:
+        return None
+    if _object_exists(s3, config.BUCKET_NAME, f"{prefix}merged"):
+        return None
+    
+    # 条件写入保证多个分片同时完成时只由一个分片合并
+    owner = str(work['index']).encode('utf-8')
+    try:
+        s3.put_object(Bucket=config.BUCKET_NAME, Key=f"{prefix}merging", Body=owner, IfNoneMatch='*')
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+        claimed_by = s3.get_object(Bucket=config.BUCKET_NAME, Key=f"{prefix}merging")['Body'].read()
+        if claimed_by != owner:
+            return None
+        logger.info("Resuming merge claimed by shard %d of %s", work['index'] + 1, work['key'])
+    
+    results = []
+    for result_key in result_keys:
+        body = s3.get_object(Bucket=config.BUCKET_NAME, Key=result_key)['Body'].read()
+        results.extend(json.loads(body))
+    return build_plot_message(work['key'], work['metric_type'], config, results, metrics)
+
+def handle_shard_event(event: dict, config: Config, s3, sqs) -> Optional[dict]:
+    """处理分片任务事件: {"shard_work": "s3://bucket/.../work_0000.json"}"""
+    work_url = urlparse(event['shard_work'])
+    work_key = work_url.path.lstrip('/')
+    work = json.loads(s3.get_object(Bucket=work_url.netloc, Key=work_key)['Body'].read())
+    
+    metrics = new_trace('csv2image', trace_id=work['run_id'], sampled=work['trace_sampled'],
+                        MetricType=work['metric_type'])
+    logger.info("Processing shard %d/%d of %s (trace_id=%s)",
+                work['index'] + 1, work['total'], work['key'], metrics.trace_id)
+    
+    results = process_shard(work, config, s3, metrics)
+    prefix = work_key.rsplit('/', 1)[0] + '/'
+    s3.put_object(Bucket=config.BUCKET_NAME, Key=f"{prefix}result_{work['index']:04d}.json",
+                  Body=json.dumps(results).encode('utf-8'))
+    
+    message = merge_shard_results(prefix, work, config, s3, metrics)
+    if message:
+        send_kwargs = {}
+        if config.QUEUE_URL.endswith('.fifo'):
+            # FIFO队列按run_id去重, 重试时不会重复投递
+            send_kwargs = {'MessageGroupId': work['run_id'], 'MessageDeduplicationId': work['run_id']}
+        with metrics.timer('sqs_publish'):
+            sqs.send_message(
+                QueueUrl=config.QUEUE_URL,
+                MessageBody=json.dumps(message),
+                **send_kwargs
+            )
+        # 发送成功后才标记完成, 发送失败时异步重试仍可重新合并
+        s3.put_object(Bucket=config.BUCKET_NAME, Key=f"{prefix}merged", Body=b'')
+        logger.info("Merged %d shards of %s", work['total'], work['key'])
+    metrics.flush()
+    return message
+
+def process_prometheus(metric_type: str, query: str, end: datetime, config: Config,
+                       s3, metrics: MetricsRecorder, step: str = None) -> dict:
+    """从Prometheus拉取时间窗口内的序列, 按服务生成图表并上传S3, 返回图表消息"""
+    if not config.PROMETHEUS_URL:
+        raise ValueError("PROMETHEUS_URL is not configured")
+    if not query:
+        raise ValueError(f"No PromQL query configured for metric type: {metric_type}")
+    
+    client = PrometheusClient(
+        config.PROMETHEUS_URL,
+        timeout=config.PROMETHEUS_TIMEOUT,
+        service_label=config.PROMETHEUS_SERVICE_LABEL,
+        pod_label=config.PROMETHEUS_POD_LABEL,
+        node_label=config.PROMETHEUS_NODE_LABEL
+    )
+    start = end - timedelta(hours=config.TIME_WINDOW_HOURS)
+    with metrics.timer('prometheus_fetch'):
+        services = client.query_range(query, start.timestamp(), end.timestamp(),
+                                      step or config.PROMETHEUS_STEP)
+    metrics.incr('services', len(services))
+    
+    # Prometheus返回UTC时间戳, 绘图坐标轴使用不带时区的UTC时间
+    max_timestamp = pd.Timestamp(end.timestamp(), unit='s')
+    min_timestamp = max_timestamp - timedelta(hours=config.TIME_WINDOW_HOURS)
+    
+    results = []
+    for service_name in sorted(services):
+        series = services[service_name]
+        metrics.incr('series', len(series))
+        # 与CSV路径保持一致, 图表隔点降采样
+        plot_series = [(label, timestamps[::2], values[::2]) for label, timestamps, values in series]
+        results.append(publish_service(service_name, plot_series, series,
+                                       min_timestamp, max_timestamp, query,
+                                       metric_type, config, s3, metrics))
+    
+    return build_plot_message(query, metric_type, config, results, metrics)
+
+def handle_prometheus_event(event: dict, config: Config, s3, sqs) -> dict:
+    """处理Prometheus定时事件, 事件格式: {"source": "prometheus", "metric_type": "cpu", "query": 可选, "step": 可选}"""
+    metric_type = event['metric_type']
+    if metric_type not in config.METRICS_CONFIG:
+        raise ValueError(f"Unknown metric type: {metric_type}")
+    query = event.get('query') or config.METRICS_CONFIG[metric_type]['promql']
+    
+    metrics = new_trace('csv2image', MetricType=metric_type)
+    logger.info("Processing %s metrics from Prometheus: %s (trace_id=%s)",
+                metric_type, query, metrics.trace_id)
+    
+    message = process_prometheus(metric_type, query, datetime.now(timezone.utc), config, s3, metrics,
+                                 step=event.get('step'))
+    
+    with metrics.timer('sqs_publish'):
+        sqs.send_message(
+            QueueUrl=config.QUEUE_URL,
+            MessageBody=json.dumps(message)
+        )
+    metrics.flush()
+    return message
+
 def lambda_handler(event, context):
     """Lambda处理函数 - CSV转图片"""
     try:
@@ -136,47 +748,76 @@ def lambda_handler(event, context):
         s3 = boto3.client('s3')
         sqs = boto3.client('sqs')
         
+        if event.get('source') == 'prometheus':
+            message = handle_prometheus_event(event, config, s3, sqs)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': 'Successfully generated plots',
+                    'metric_type': message['metric_type'],
+                    'time_window_hours': config.TIME_WINDOW_HOURS,
+                    'trace_id': message['trace_id'],
+                    'results': message['plots']
+                })
+            }
+        
+        if 'shard_work' in event:
+            message = handle_shard_event(event, config, s3, sqs)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': 'Successfully processed shard',
+                    'merged': message is not None
+                })
+            }
+        
         s3_event = event['Records'][0]['s3']
         bucket = s3_event['bucket']['name']
         key = s3_event['object']['key']
         
+        if key.endswith(config.SHARD_MANIFEST_SUFFIX):
+            logger.info("Skipping shard manifest: %s", key)
+            return {'statusCode': 200, 'body': json.dumps({'message': 'Skipped shard manifest'})}
+        
         metric_type = get_metric_type(key.split('/')[-1])
-        logger.info(f"Processing {metric_type} metrics from file: {bucket}/{key}")
+        metrics = new_trace('csv2image', MetricType=metric_type)
+        logger.info("Processing %s metrics from file: %s/%s (trace_id=%s)",
+                    metric_type, bucket, key, metrics.trace_id)
+        
+        size = s3_event['object'].get('size')
+        if size is None:
+            size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        if config.SHARD_THRESHOLD_MB and size > config.SHARD_THRESHOLD_MB * 1024 * 1024:
+            shards = coordinate_shards(bucket, key, metric_type, config, s3,
+                                       boto3.client('lambda'), context.function_name, metrics)
+            if shards:
+                metrics.flush()
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({
+                        'message': 'Dispatched shards',
+                        'metric_type': metric_type,
+                        'trace_id': metrics.trace_id,
+                        'shards': shards
+                    })
+                }
         
         csv_temp = tempfile.NamedTemporaryFile(suffix='.csv', prefix='input_', 
                                              dir='/tmp', delete=False)
-        s3.download_file(bucket, key, csv_temp.name)
+        with metrics.timer('s3_download'):
+            s3.download_file(bucket, key, csv_temp.name)
         
-        df = pd.read_csv(csv_temp.name)
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        os.unlink(csv_temp.name)
+        try:
+            message = process_csv(csv_temp.name, key, metric_type, config, s3, metrics)
+        finally:
+            os.unlink(csv_temp.name)
         
-        results = []
-        for service_name, service_data in df.groupby('service'):
-            plot_file = generate_plot(service_data, service_name, config, metric_type)
-            output_key = (f"{config.OUTPUT_PREFIX}{metric_type}/{service_name}/"
-                         f"plot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
-            
-            s3.upload_file(plot_file, config.BUCKET_NAME, output_key)
-            results.append({
-                'service': service_name,
-                'plot_path': f"s3://{config.BUCKET_NAME}/{output_key}",
-                'source_csv': key,
-                'metric_type': metric_type,
-                'time_window_hours': config.TIME_WINDOW_HOURS
-            })
-            os.unlink(plot_file)
-        
-        sqs.send_message(
-            QueueUrl=config.QUEUE_URL,
-            MessageBody=json.dumps({
-                'timestamp': datetime.now().isoformat(),
-                'source_csv': key,
-                'metric_type': metric_type,
-                'time_window_hours': config.TIME_WINDOW_HOURS,
-                'plots': results
-            })
-        )
+        with metrics.timer('sqs_publish'):
+            sqs.send_message(
+                QueueUrl=config.QUEUE_URL,
+                MessageBody=json.dumps(message)
+            )
+        metrics.flush()
         
         return {
             'statusCode': 200,
@@ -184,7 +825,8 @@ def lambda_handler(event, context):
                 'message': 'Successfully generated plots',
                 'metric_type': metric_type,
                 'time_window_hours': config.TIME_WINDOW_HOURS,
-                'results': results
+                'trace_id': metrics.trace_id,
+                'results': message['plots']
             })
         }
         
@@ -0,0 +1,79 @@
+import json
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger()
+
+Series = Tuple[str, np.ndarray, np.ndarray]
+
+class PrometheusError(Exception):
+    """Prometheus API调用异常"""
+    pass
+
+class PrometheusClient:
+    """Prometheus query_range 客户端, 直接输出绘图所需的NumPy序列"""
+    def __init__(self, base_url: str, timeout: int = 30, headers: Optional[Dict] = None,
+                 service_label: str = 'service', pod_label: str = 'pod', node_label: str = 'node'):
+        self.endpoint = base_url.rstrip('/') + '/api/v1/query_range'
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.service_label = service_label
+        self.pod_label = pod_label
+        self.node_label = node_label
+
+    @staticmethod
+    def _decode_series(obj: Dict) -> Dict:
+        """JSON解码回调: 每解析完一条matrix结果立即转换为NumPy数组, 释放原始列表"""
+        if 'values' in obj and 'metric' in obj:
+            # values形如 [[1700000000.123, "0.42"], ...], 数值为字符串(含"NaN"/"+Inf")
+            samples = np.array(obj.pop('values'), dtype=np.float64).reshape(-1, 2)
+            obj['timestamps'] = (samples[:, 0] * 1000).astype('datetime64[ms]')
+            obj['values'] = samples[:, 1]
+        return obj
+
+    def query_range(self, query: str, start: float, end: float, step: str) -> Dict[str, List[Series]]:
+        """执行区间查询, 按service分组返回 (pod-node标签, 时间戳数组, 数值数组) 列表"""
+        params = urllib.parse.urlencode({'query': query, 'start': start, 'end': end, 'step': step})
+        request = urllib.request.Request(f"{self.endpoint}?{params}", headers=self.headers)
+
+        try:
+            logger.info("查询Prometheus - Query: %s, Step: %s", query, step)
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                # json.load会一次读入完整响应体, 并非增量解析; object_hook在每条序列解析完后立即转为NumPy数组,
+                # 避免所有序列的Python列表同时驻留内存
+                payload = json.load(response, object_hook=self._decode_series)
+        except urllib.error.HTTPError as e:
+            raise PrometheusError(f"HTTP请求失败: {e.code} {e.reason} {e.read().decode('utf-8')}")
+        except (urllib.error.URLError, json.JSONDecodeError) as e:
+            raise PrometheusError(f"查询Prometheus失败: {str(e)}")
+
+        if payload.get('status') != 'success':
+            raise PrometheusError(f"查询失败: {payload.get('errorType')} {payload.get('error')}")
+        data = payload['data']
+        if data.get('resultType') != 'matrix':
+            raise PrometheusError(f"非预期的结果类型: {data.get('resultType')}")
+
+        return self._group_by_service(data['result'])
+
+    def _group_by_service(self, results: List[Dict]) -> Dict[str, List[Series]]:
+        """将标签映射为service/pod/node, 按service分组并按pod、node排序"""
+        grouped = {}
+        for result in results:
+            labels = result['metric']
+            service = labels.get(self.service_label)
+            if not service:
+                logger.warning("跳过缺少%s标签的序列: %s", self.service_label, labels)
+                continue
+            key = (labels.get(self.pod_label, ''), labels.get(self.node_label, ''))
+            grouped.setdefault(service, []).append((key, result['timestamps'], result['values']))
+
+        return {
+            service: [(f"{pod}-{node}", timestamps, values)
+                      for (pod, node), timestamps, values in sorted(items, key=lambda item: item[0])]
+            for service, items in grouped.items()
+        }
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# lambda_function在导入时读取BUCKET_NAME
+os.environ.setdefault('BUCKET_NAME', 'test-bucket')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
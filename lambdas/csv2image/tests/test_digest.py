@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import lambda_function as lf
+
+def _digest(values: np.ndarray) -> dict:
+    timestamps = pd.date_range('2024-01-01', periods=len(values), freq='30s').to_numpy()
+    config = lf.Config()
+    metrics = lf.MetricsRecorder('csv2image', '', sampled=False)
+    digest = lf.compute_digest([('order-1-10.0.0.1', timestamps, values)], timestamps[0], timestamps[-1],
+                               'order', config, 'cpu', metrics)
+    return digest['series'][0]
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('count', [60, 120, 960])
+def test_spike_does_not_create_neighbour_outliers_or_change_points(seed, count):
+    values = np.random.default_rng(seed).uniform(0, 60, count)
+    values[count // 2:] += 50
+    values[count // 4] = 500
+
+    series = _digest(values)
+
+    assert [outlier['value'] for outlier in series['outliers']] == [500.0]
+    spike_time = pd.Timestamp('2024-01-01') + pd.Timedelta(seconds=30 * (count // 4))
+    assert all(abs(pd.Timestamp(point['timestamp']) - spike_time) > pd.Timedelta(minutes=1)
+               for point in series['change_points'])
+
+def test_level_shift_is_reported_once():
+    values = np.random.default_rng(0).uniform(0, 60, 120)
+    values[60:] += 50
+    values[30] = 500
+
+    series = _digest(values)
+
+    assert [point['timestamp'] for point in series['change_points']] == ['2024-01-01T00:30:00']
+    assert series['change_points'][0]['shift'] == pytest.approx(50, abs=10)
+
+def test_mixed_timezone_offsets_are_normalised_to_utc(tmp_path):
+    csv_path = tmp_path / 'cpu.csv'
+    csv_path.write_text('timestamp,service,pod,node,cpuusage\n'
+                        '2024-01-01T08:00:00+08:00,order,order-1,10.0.0.1,1\n'
+                        '2024-01-01T01:00:00+00:00,order,order-1,10.0.0.1,2\n')
+
+    df = lf.read_metrics_csv(str(csv_path))
+    [(_, timestamps, values)], _, max_timestamp = lf.dataframe_to_series(df, lf.Config(), 'cpu')
+
+    assert timestamps.dtype == np.dtype('datetime64[ns]')
+    assert list(np.datetime_as_string(timestamps, unit='s')) == ['2024-01-01T00:00:00', '2024-01-01T01:00:00']
+    assert max_timestamp == pd.Timestamp('2024-01-01T01:00:00')
@@ -0,0 +1,93 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pytest
+
+from prometheus_adapter import PrometheusClient, PrometheusError
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    """返回server.payload, 并记录请求参数"""
+    def do_GET(self):
+        self.server.requests.append(urllib.parse.urlparse(self.path))
+        body = json.dumps(self.server.payload).encode('utf-8')
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), _FixtureHandler)
+    httpd.payload, httpd.status, httpd.requests = {}, 200, []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def _url(httpd) -> str:
+    return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+def _matrix(*results) -> dict:
+    return {'status': 'success', 'data': {'resultType': 'matrix', 'result': list(results)}}
+
+def test_decodes_matrix_values(server):
+    server.payload = _matrix({
+        'metric': {'service': 'order', 'pod': 'order-1', 'node': '10.0.0.1'},
+        'values': [[1700000000.5, 'NaN'], [1700000001.25, '+Inf'], [1700000002, '0.42']]
+    })
+    services = PrometheusClient(_url(server)).query_range('up', 1700000000, 1700000002, '1s')
+
+    [(label, timestamps, values)] = services['order']
+    assert label == 'order-1-10.0.0.1'
+    assert timestamps.dtype == np.dtype('datetime64[ms]')
+    assert list(timestamps) == [np.datetime64(ms, 'ms') for ms in (1700000000500, 1700000001250, 1700000002000)]
+    assert np.isnan(values[0]) and values[1] == np.inf and values[2] == 0.42
+
+    params = urllib.parse.parse_qs(server.requests[0].query)
+    assert server.requests[0].path == '/api/v1/query_range'
+    assert params['query'] == ['up'] and params['step'] == ['1s']
+
+def test_remaps_labels_and_sorts_by_pod_node(server):
+    server.payload = _matrix(
+        {'metric': {'app': 'cart', 'instance': 'cart-2', 'host': 'b'}, 'values': [[1, '2']]},
+        {'metric': {'app': 'cart', 'instance': 'cart-1', 'host': 'a'}, 'values': [[1, '1']]},
+        {'metric': {'app': 'user', 'instance': 'user-1'}, 'values': [[1, '3']]}
+    )
+    client = PrometheusClient(_url(server), service_label='app', pod_label='instance', node_label='host')
+    services = client.query_range('up', 0, 1, '1s')
+
+    assert [label for label, _, _ in services['cart']] == ['cart-1-a', 'cart-2-b']
+    assert [label for label, _, _ in services['user']] == ['user-1-']
+
+def test_skips_series_without_service_label(server):
+    server.payload = _matrix(
+        {'metric': {'pod': 'orphan', 'node': 'a'}, 'values': [[1, '1']]},
+        {'metric': {'service': 'order', 'pod': 'order-1', 'node': 'a'}, 'values': [[1, '1']]}
+    )
+    services = PrometheusClient(_url(server)).query_range('up', 0, 1, '1s')
+
+    assert list(services) == ['order']
+
+def test_raises_on_error_status(server):
+    server.payload = {'status': 'error', 'errorType': 'bad_data', 'error': 'parse error'}
+    with pytest.raises(PrometheusError, match='bad_data'):
+        PrometheusClient(_url(server)).query_range('up{', 0, 1, '1s')
+
+def test_raises_on_http_error(server):
+    server.status = 422
+    server.payload = {'status': 'error', 'errorType': 'execution', 'error': 'too many samples'}
+    with pytest.raises(PrometheusError, match='422'):
+        PrometheusClient(_url(server)).query_range('up', 0, 1, '1s')
+
+def test_raises_on_non_matrix_result(server):
+    server.payload = {'status': 'success', 'data': {'resultType': 'vector', 'result': []}}
+    with pytest.raises(PrometheusError, match='vector'):
+        PrometheusClient(_url(server)).query_range('up', 0, 1, '1s')
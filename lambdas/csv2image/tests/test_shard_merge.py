@@ -0,0 +1,140 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import lambda_function as lf
+
+BUCKET = 'test-bucket'
+
+class _Body(io.BytesIO):
+    def iter_lines(self, chunk_size=1024, keepends=False):
+        return iter(self.readlines())
+
+class FakeS3:
+    """内存S3: 支持区间读取、IfNoneMatch条件写入和分页列举"""
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        data = self.objects[Key]
+        if Range:
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            data = data[start:end + 1]
+        return {'Body': _Body(data)}
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, **kwargs):
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.objects[Key] = Body
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Key])}
+
+    def get_paginator(self, name):
+        objects = self.objects
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{'Contents': [{'Key': key} for key in sorted(objects) if key.startswith(Prefix)]}]
+        return Paginator()
+
+class FakeSQS:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ClientError({'Error': {'Code': 'ServiceUnavailable'}}, 'SendMessage')
+        self.messages.append(json.loads(MessageBody))
+
+class FakeLambda:
+    def __init__(self):
+        self.events = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.events.append(json.loads(Payload))
+
+@pytest.fixture
+def config():
+    config = lf.Config()
+    config.OUTPUT_MODE = 'digest'
+    config.SHARD_TARGET_MB = 0.001
+    return config
+
+@pytest.fixture
+def shards(config):
+    """按服务排序的CSV划分为3个分片, 返回 (s3, 分片事件列表)"""
+    rows = ''.join(f"2024-01-01 00:{minute:02d}:00,{service},{service}-1,10.0.0.1,{minute}\n"
+                   for service in ('007', 'cart', 'order') for minute in range(30))
+    s3 = FakeS3()
+    s3.objects['data/cpu.csv'] = ('timestamp,service,pod,node,cpuusage\n' + rows).encode('utf-8')
+    lambda_client = FakeLambda()
+    metrics = lf.MetricsRecorder('csv2image', 'run-1', sampled=False)
+    assert lf.coordinate_shards(BUCKET, 'data/cpu.csv', 'cpu', config, s3,
+                                lambda_client, 'csv2image', metrics) == 3
+    return s3, lambda_client.events
+
+def _merge_keys(s3):
+    prefix = f"{lf.Config.OUTPUT_PREFIX}_shards/run-1/"
+    return {key[len(prefix):] for key in s3.objects if key.startswith(prefix) and key.endswith(('merging', 'merged'))}
+
+def test_last_shard_merges_all_services(config, shards):
+    s3, events = shards
+    sqs = FakeSQS()
+
+    assert lf.handle_shard_event(events[0], config, s3, sqs) is None
+    assert lf.handle_shard_event(events[1], config, s3, sqs) is None
+    message = lf.handle_shard_event(events[2], config, s3, sqs)
+
+    assert sorted(plot['service'] for plot in message['plots']) == ['007', 'cart', 'order']
+    assert message['trace_id'] == 'run-1'
+    assert len(sqs.messages) == 1
+    assert _merge_keys(s3) == {'merging', 'merged'}
+
+def test_concurrent_claim_merges_once(config, shards):
+    s3, events = shards
+    sqs = FakeSQS()
+    for event in events:
+        lf.handle_shard_event(event, config, s3, sqs)
+    assert len(sqs.messages) == 1
+
+    # 另一个分片的重复执行在合并已完成后不再发送
+    del s3.objects[f"{lf.Config.OUTPUT_PREFIX}_shards/run-1/merged"]
+    assert lf.handle_shard_event(events[0], config, s3, sqs) is None
+    assert len(sqs.messages) == 1
+
+def test_claimer_retry_resends_after_failed_send(config, shards):
+    s3, events = shards
+    sqs = FakeSQS(failures=1)
+    lf.handle_shard_event(events[0], config, s3, sqs)
+    lf.handle_shard_event(events[1], config, s3, sqs)
+
+    with pytest.raises(ClientError):
+        lf.handle_shard_event(events[2], config, s3, sqs)
+    assert _merge_keys(s3) == {'merging'}
+
+    # 其他分片不能接管已被认领的合并
+    assert lf.handle_shard_event(events[0], config, s3, sqs) is None
+    # 认领分片的异步重试完成合并
+    assert lf.handle_shard_event(events[2], config, s3, sqs) is not None
+    assert len(sqs.messages) == 1
+    assert _merge_keys(s3) == {'merging', 'merged'}
+
+def test_fifo_queue_deduplicates_on_run_id(config, shards):
+    s3, events = shards
+    sent = []
+    class RecordingSQS(FakeSQS):
+        def send_message(self, QueueUrl, MessageBody, **kwargs):
+            sent.append(kwargs)
+    config.QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/123/plots.fifo'
+    for event in events:
+        lf.handle_shard_event(event, config, s3, RecordingSQS())
+
+    assert sent == [{'MessageGroupId': 'run-1', 'MessageDeduplicationId': 'run-1'}]
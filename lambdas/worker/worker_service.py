@@ -0,0 +1,268 @@
+"""常驻worker模式 - 用于没有Lambda的本地/IDC集群
+
+监听本地目录(或FIFO命名管道)中的CSV文件, 通过两级流水线处理:
+    目录/FIFO -> [csv队列] -> csv2image进程池 -> [图表队列] -> metrics_analyzer线程池
+
+两级队列均有容量上限, 下游处理不过来时上游会阻塞(背压)。
+S3/Dify/Lark客户端在每个worker内只创建一次, 在整个进程生命周期内复用。
+"""
+import os
+import sys
+import stat
+import time
+import queue
+import uuid
+import signal
+import shutil
+import logging
+import argparse
+import threading
+import multiprocessing as mp
+from typing import List, Optional
+
+_LAMBDAS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_LAMBDAS_DIR, 'csv2image'))
+sys.path.insert(0, os.path.join(_LAMBDAS_DIR, 'claude3-analyze-metrics-plots'))
+
+import boto3
+import lambda_function as csv2image
+import metrics_analyzer
+
+logger = logging.getLogger()
+
+class WorkerConfig:
+    """Worker配置类"""
+    WATCH_DIR = os.environ.get('WATCH_DIR', '/data/metrics')
+    FIFO_PATH = os.environ.get('FIFO_PATH', '')
+    POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL_SECONDS', '5'))
+
+    # 并发配置: 绘图为CPU密集型(多进程), 分析为IO密集型(多线程)
+    RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', str(os.cpu_count() or 1)))
+    ANALYZE_WORKERS = int(os.environ.get('ANALYZE_WORKERS', '4'))
+
+    # 队列容量配置
+    CSV_QUEUE_SIZE = int(os.environ.get('CSV_QUEUE_SIZE', '16'))
+    PLOT_QUEUE_SIZE = int(os.environ.get('PLOT_QUEUE_SIZE', '32'))
+    QUEUE_PUT_TIMEOUT = 1
+
+    # 文件状态目录 (相对WATCH_DIR)
+    PROCESSING_DIR = '.processing'
+    DONE_DIR = '.done'
+    FAILED_DIR = '.failed'
+
+def _move(path: str, watch_dir: str, state_dir: str, name: Optional[str] = None) -> str:
+    """将文件移动到指定状态目录, 返回新路径"""
+    target_dir = os.path.join(watch_dir, state_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, name or os.path.basename(path))
+    shutil.move(path, target)
+    return target
+
+def _claim(path: str, watch_dir: str) -> str:
+    """认领文件到处理中目录, 文件名追加时间戳和随机后缀, 避免上游复用文件名时互相覆盖"""
+    stem, ext = os.path.splitext(os.path.basename(path))
+    name = f"{stem}.{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}{ext}"
+    return _move(path, watch_dir, WorkerConfig.PROCESSING_DIR, name)
+
+class DirectorySource:
+    """目录监听数据源, 通过rename认领文件, 避免重复处理
+
+    文件需在连续两次轮询间大小和修改时间都不变才会被认领, 避免读取上游仍在写入的文件。
+    上游最好先写入临时文件名(非.csv后缀), 写完后再rename为.csv。
+    """
+    def __init__(self, watch_dir: str):
+        self.watch_dir = watch_dir
+        os.makedirs(os.path.join(watch_dir, WorkerConfig.PROCESSING_DIR), exist_ok=True)
+        self._recovered = self._recover()
+        self._seen = {}
+
+    def _recover(self) -> List[str]:
+        """返回上次退出时遗留在处理中目录的文件(异常退出或未入队), 首次轮询时重新处理"""
+        processing_dir = os.path.join(self.watch_dir, WorkerConfig.PROCESSING_DIR)
+        recovered = []
+        for name in sorted(os.listdir(processing_dir)):
+            logger.warning("恢复未完成的文件: %s", name)
+            recovered.append(os.path.join(processing_dir, name))
+        return recovered
+
+    def _take_recovered(self) -> List[str]:
+        recovered, self._recovered = self._recovered, []
+        return recovered
+
+    def poll(self) -> List[str]:
+        """认领目录下已写入完成的CSV文件, 返回认领后的路径列表"""
+        claimed = self._take_recovered()
+        seen = {}
+        for name in sorted(os.listdir(self.watch_dir)):
+            path = os.path.join(self.watch_dir, name)
+            if not name.endswith('.csv') or not os.path.isfile(path):
+                continue
+            stat_result = os.stat(path)
+            signature = (stat_result.st_size, stat_result.st_mtime_ns)
+            if self._seen.get(name) != signature:
+                # 新出现或仍在写入, 下次轮询再确认
+                seen[name] = signature
+                continue
+            try:
+                claimed.append(_claim(path, self.watch_dir))
+            except OSError as e:
+                logger.error(f"认领文件失败 {name}: {str(e)}")
+        self._seen = seen
+        return claimed
+
+class FifoSource(DirectorySource):
+    """FIFO数据源, 上游每行写入一个CSV文件路径(需位于WATCH_DIR下)"""
+    def __init__(self, watch_dir: str, fifo_path: str):
+        super().__init__(watch_dir)
+        if not os.path.exists(fifo_path):
+            os.mkfifo(fifo_path)
+        elif not stat.S_ISFIFO(os.stat(fifo_path).st_mode):
+            raise ValueError(f"不是FIFO文件: {fifo_path}")
+        # O_RDWR保证没有写端时open/read不会阻塞或读到EOF
+        self._fd = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        self._buffer = b''
+
+    def poll(self) -> List[str]:
+        """读取FIFO中的文件路径并认领, 首次轮询时同时返回上次遗留的文件"""
+        try:
+            self._buffer += os.read(self._fd, 65536)
+        except BlockingIOError:
+            pass
+        *lines, self._buffer = self._buffer.split(b'\n')
+        claimed = self._take_recovered()
+        for line in lines:
+            # 非法编码的行替换后路径不存在, 在认领时记录错误并跳过, 不影响主循环
+            path = line.decode('utf-8', errors='replace').strip()
+            if not path:
+                continue
+            try:
+                claimed.append(_claim(path, self.watch_dir))
+            except OSError as e:
+                logger.error(f"认领文件失败 {path}: {str(e)}")
+        return claimed
+
+def _put(q, item, stop: Optional[threading.Event] = None) -> bool:
+    """阻塞写入有界队列, 收到停止信号时放弃"""
+    while True:
+        try:
+            q.put(item, timeout=WorkerConfig.QUEUE_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            if stop is not None and stop.is_set():
+                return False
+
+def render_worker(csv_queue, plot_queue, watch_dir: str) -> None:
+    """绘图进程: CSV -> 图表 -> 图表消息"""
+    # 由主进程统一处理信号, 子进程处理完队列中的任务后退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    config = csv2image.Config()
+    s3 = boto3.client('s3')
+
+    while True:
+        path = csv_queue.get()
+        if path is None:
+            break
+
+        name = os.path.basename(path)
+        try:
+            metric_type = csv2image.get_metric_type(name)
+            metrics = csv2image.new_trace('csv2image', MetricType=metric_type)
+            logger.info("Processing %s metrics from file: %s (trace_id=%s)",
+                        metric_type, path, metrics.trace_id)
+            message = csv2image.process_csv(path, name, metric_type, config, s3, metrics)
+            metrics.flush()
+            _put(plot_queue, message)
+            _move(path, watch_dir, WorkerConfig.DONE_DIR)
+        except Exception as e:
+            logger.error(f"Error processing CSV file {name}: {str(e)}")
+            # 移动失败不能让绘图进程退出, 否则进程池会静默缩小
+            try:
+                _move(path, watch_dir, WorkerConfig.FAILED_DIR)
+            except OSError as move_error:
+                logger.error(f"移动失败文件出错 {name}: {str(move_error)}")
+
+def analyze_worker(plot_queue, dify_client: metrics_analyzer.DifyClient,
+                   lark_bot: metrics_analyzer.LarkBot) -> None:
+    """分析线程: 图表消息 -> Dify -> Lark"""
+    while True:
+        message = plot_queue.get()
+        if message is None:
+            break
+        try:
+            metrics_analyzer.process_message(message, dify_client, lark_bot)
+            logger.info("消息处理完成")
+        except Exception as e:
+            logger.error(f"处理消息时发生错误: {str(e)}")
+
+def run(watch_dir: str, fifo_path: str = '', render_workers: int = WorkerConfig.RENDER_WORKERS,
+        analyze_workers: int = WorkerConfig.ANALYZE_WORKERS) -> None:
+    """启动流水线, 直到收到SIGINT/SIGTERM后处理完已认领的文件再退出"""
+    source = FifoSource(watch_dir, fifo_path) if fifo_path else DirectorySource(watch_dir)
+    csv_queue = mp.Queue(maxsize=WorkerConfig.CSV_QUEUE_SIZE)
+    plot_queue = mp.Queue(maxsize=WorkerConfig.PLOT_QUEUE_SIZE)
+
+    stop = threading.Event()
+    def _handle_signal(signum, frame):
+        logger.info("收到信号 %s, 停止接收新文件", signum)
+        stop.set()
+    signal.signal(signal.SIGINT, _handle_signal)
+    signal.signal(signal.SIGTERM, _handle_signal)
+
+    renderers = [
+        mp.Process(target=render_worker, args=(csv_queue, plot_queue, watch_dir),
+                   name=f'render-{i}', daemon=True)
+        for i in range(render_workers)
+    ]
+    # boto3默认session的客户端创建不是线程安全的, 在主线程中创建后交给各线程复用
+    analyzers = [
+        threading.Thread(target=analyze_worker,
+                         args=(plot_queue, metrics_analyzer.DifyClient(), metrics_analyzer.LarkBot()),
+                         name=f'analyze-{i}', daemon=True)
+        for i in range(analyze_workers)
+    ]
+    for worker in renderers + analyzers:
+        worker.start()
+    logger.info("Worker已启动 - 目录: %s, 绘图进程: %d, 分析线程: %d",
+                watch_dir, render_workers, analyze_workers)
+
+    pending = []
+    while not stop.is_set():
+        if not pending:
+            pending = source.poll()
+        while pending and _put(csv_queue, pending[0], stop):
+            pending.pop(0)
+        if not pending:
+            stop.wait(WorkerConfig.POLL_INTERVAL)
+
+    # 未入队的文件保留在处理中目录, 下次启动时重新处理
+    if pending:
+        logger.info("%d 个文件未入队, 将在下次启动时处理", len(pending))
+
+    logger.info("等待绘图进程处理完队列中的文件")
+    for _ in renderers:
+        _put(csv_queue, None)
+    for worker in renderers:
+        worker.join()
+
+    logger.info("等待分析线程处理完队列中的图表")
+    for _ in analyzers:
+        _put(plot_queue, None)
+    for worker in analyzers:
+        worker.join()
+    logger.info("Worker已退出")
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='BedrockWatch 常驻worker')
+    parser.add_argument('--watch-dir', default=WorkerConfig.WATCH_DIR, help='监听的CSV目录')
+    parser.add_argument('--fifo', default=WorkerConfig.FIFO_PATH,
+                        help='从FIFO读取CSV路径, 不再轮询目录')
+    parser.add_argument('--render-workers', type=int, default=WorkerConfig.RENDER_WORKERS)
+    parser.add_argument('--analyze-workers', type=int, default=WorkerConfig.ANALYZE_WORKERS)
+    args = parser.parse_args(argv)
+
+    run(args.watch_dir, args.fifo, args.render_workers, args.analyze_workers)
+
+if __name__ == '__main__':
+    main()